@@ -1,7 +1,93 @@
+import errno
+import os
 import requests
+import shutil
+import subprocess
+import tempfile
 
-def fetch_to_file(url, file):
-    with open(file, 'wb') as f:
-        r = requests.get(url, stream=True)
-        for chunk in r.iter_content(1024):
-            f.write(chunk)
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+def make_session(pool_size=32):
+    '''
+    Make a requests Session that keeps connections to each host alive
+    across requests, retrying transient server errors.
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          # Hand back the last response rather than raising, so
+                          # callers' status code checks still work.
+                          max_retries=Retry(total=3, backoff_factor=0.5,
+                                            status_forcelist=(500, 502, 503, 504),
+                                            raise_on_status=False))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+SESSION = make_session()
+
+def make_scratch_dir(suffix=''):
+    '''
+    Make a temporary directory to extract debs into. This goes wherever
+    TMPDIR says, so set TMPDIR=/dev/shm to extract into memory on machines
+    where /dev/shm is big enough to hold the largest -dbg debs.
+    '''
+    return tempfile.mkdtemp(suffix=suffix)
+
+def empty_dir(path):
+    '''
+    Remove everything inside `path`, leaving the directory itself.
+    '''
+    for entry in os.listdir(path):
+        entry = os.path.join(path, entry)
+        if os.path.isdir(entry) and not os.path.islink(entry):
+            shutil.rmtree(entry)
+        else:
+            os.remove(entry)
+
+def extract_deb(url, dest, members=(), exclude=()):
+    '''
+    Stream the deb at `url` through dpkg-deb into tar, extracting its
+    contents (or just `members`, if given, less anything under `exclude`)
+    under `dest` without ever writing the deb itself to disk.
+    '''
+    dpkg_args = ['dpkg-deb', '--fsys-tarfile', '/dev/stdin']
+    tar_args = (['tar', 'x'] + ['--exclude=' + e for e in exclude] +
+                list(members))
+    r = SESSION.get(url, stream=True)
+    procs = []
+    try:
+        # Don't feed an error page to dpkg-deb.
+        r.raise_for_status()
+        dpkg = subprocess.Popen(dpkg_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        procs.append(dpkg)
+        tar = subprocess.Popen(tar_args, stdin=dpkg.stdout, cwd=dest)
+        procs.append(tar)
+        # Only tar should hold the read end, so dpkg-deb sees it exit.
+        dpkg.stdout.close()
+        try:
+            for chunk in r.iter_content(64 * 1024):
+                dpkg.stdin.write(chunk)
+        except IOError as e:
+            # dpkg-deb gave up early; its exit status says why.
+            if e.errno != errno.EPIPE:
+                raise
+        finally:
+            try:
+                dpkg.stdin.close()
+            except IOError:
+                pass
+        for proc, args in ((dpkg, dpkg_args), (tar, tar_args)):
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, args)
+    except Exception:
+        # Make sure tar isn't still writing into dest while the caller
+        # cleans it up.
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+        raise
+    finally:
+        r.close()
@@ -14,38 +14,157 @@ information needed to download the relevant package.
 
 from __future__ import print_function
 
-import html5lib
+import atexit
+import binascii
 import itertools
 import json
 import logging
+import lxml.html
+import mmap
 import multiprocessing
 import os
 import re
-import requests
 import shutil
+import stat
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import urlparse
 
-from common import fetch_to_file
+from common import SESSION, empty_dir, extract_deb, make_scratch_dir
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 log = logging.getLogger('scanpackages')
 
 class AutoSaveDict(dict):
-    def __init__(self, path):
+    """A dict that persists itself to `path` as JSON. Each write is appended to a
+journal next to it, which gets folded back into `path` every `compact_every` writes,
+on startup, and by compact(). delete() removes both files."""
+    def __init__(self, path, compact_every=10000):
         if os.path.isfile(path):
             self.update(json.load(open(path, 'rb')))
         self.path = path
-    def __setitem__(self, *args, **kwargs):
-        dict.__setitem__(self, *args, **kwargs)
-        with tempfile.NamedTemporaryFile(delete=False) as f:
+        self.journal_path = path + '.journal'
+        self.compact_every = compact_every
+        self.writes = 0
+        if os.path.isfile(self.journal_path):
+            for line in open(self.journal_path, 'rb'):
+                try:
+                    key, value = json.loads(line)
+                except ValueError:
+                    # The last write was cut short by a crash.
+                    break
+                dict.__setitem__(self, key, value)
+        self.journal_fd = os.open(self.journal_path,
+                                  os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        # Fold in whatever was left, including any torn record, so that new
+        # writes never get appended after a partial line.
+        if os.fstat(self.journal_fd).st_size:
+            self.compact()
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        os.write(self.journal_fd, json.dumps([key, value]) + '\n')
+        self.writes += 1
+        if self.writes >= self.compact_every:
+            self.compact()
+    def compact(self):
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(self.path) or '.',
+                                         delete=False) as f:
             json.dump(self, f)
-            f.close()
-            os.rename(f.name, self.path)
+        os.rename(f.name, self.path)
+        os.ftruncate(self.journal_fd, 0)
+        self.writes = 0
+    def delete(self):
+        os.close(self.journal_fd)
+        for path in (self.path, self.journal_path):
+            if os.path.isfile(path):
+                os.remove(path)
 
-def GetBuildID(dso):
+ELF_MAGIC = b'\x7fELF'
+ELFCLASS32, ELFCLASS64 = 1, 2
+PT_NOTE = 4
+SHT_NOTE = 7
+NT_GNU_BUILD_ID = 3
+
+def is_elf(path):
+    """Cheaply check whether the specified file starts with the ELF magic number."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, 4) == ELF_MAGIC
+    finally:
+        os.close(fd)
+
+def find_gnu_build_id(m, endian, offset, size):
+    """Walk the ELF notes in m[offset:offset+size] looking for the GNU build ID
+note, and return it as a hex string, or None if it isn't there."""
+    end = offset + size
+    while offset + 12 <= end:
+        namesz, descsz, note_type = struct.unpack_from(endian + 'III', m, offset)
+        offset += 12
+        name = m[offset:offset + namesz]
+        offset += (namesz + 3) & ~3
+        desc = m[offset:offset + descsz]
+        offset += (descsz + 3) & ~3
+        if note_type == NT_GNU_BUILD_ID and name[:3] == b'GNU':
+            return binascii.hexlify(desc)
+    return None
+
+def get_build_id_mmap(path):
+    """This function maps the specified file into memory and, if it is an ELF file,
+walks its note segments (or note sections, for files without program headers) to
+find its build ID. If no build ID is found then it returns None."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        # Too small to even hold e_ident, and mmap refuses empty files anyway.
+        if size < 16:
+            return None
+        m = mmap.mmap(fd, size, prot=mmap.PROT_READ)
+    finally:
+        os.close(fd)
+    try:
+        magic, ei_class, ei_data = struct.unpack_from('4sBB', m, 0)
+        if magic != ELF_MAGIC:
+            return None
+        endian = {1: '<', 2: '>'}[ei_data]
+        if ei_class == ELFCLASS32:
+            phoff, shoff = struct.unpack_from(endian + 'II', m, 28)
+            phentsize, phnum, shentsize, shnum = struct.unpack_from(endian + 'HHHH', m, 42)
+            phdr, shdr = endian + 'II8xI', endian + '4xI8xII'
+        elif ei_class == ELFCLASS64:
+            phoff, shoff = struct.unpack_from(endian + 'QQ', m, 32)
+            phentsize, phnum, shentsize, shnum = struct.unpack_from(endian + 'HHHH', m, 54)
+            phdr, shdr = endian + 'I4xQ16xQ', endian + '4xI16xQQ'
+        else:
+            raise ValueError('Unknown ELF class %d' % ei_class)
+
+        # Program headers: p_type, p_offset, p_filesz.
+        for i in range(phnum):
+            p_type, p_offset, p_filesz = struct.unpack_from(phdr, m, phoff + i * phentsize)
+            if p_type == PT_NOTE:
+                buildID = find_gnu_build_id(m, endian, p_offset, p_filesz)
+                if buildID:
+                    return buildID
+        # Section headers: sh_type, sh_offset, sh_size. Relocatable objects
+        # have no program headers, and the program headers in separate debug
+        # files don't necessarily describe the file's own contents.
+        for i in range(shnum):
+            sh_type, sh_offset, sh_size = struct.unpack_from(shdr, m, shoff + i * shentsize)
+            if sh_type == SHT_NOTE:
+                buildID = find_gnu_build_id(m, endian, sh_offset, sh_size)
+                if buildID:
+                    return buildID
+        return None
+    finally:
+        m.close()
+
+# We're looking for this line in readelf's output:
+# Build ID: 99c2106c44189e354e1826aa285a0ccf7cbdf726
+BUILD_ID_RE = re.compile(r'^\s*Build ID: (.*?)\s*$', re.M)
+
+def get_build_id_readelf(dso):
     """This function uses 'file' and 'readelf' to see if the specified file is an ELF
 file, and if so to try to get its build ID. If no build ID is found then it returns None."""
     # First see if the file is an ELF file -- this avoids error messages
@@ -56,52 +175,121 @@ file, and if so to try to get its build ID. If no build ID is found then it retu
     # Now execute readelf. Note that some older versions don't understand build IDs.
     # If you are running such an old version then you can dump the contents of the
     # build ID section and parse the raw data.
-    lines = subprocess.check_output(['readelf', '-n', dso]).splitlines()
-    # We're looking for this output:
-    # Build ID: 99c2106c44189e354e1826aa285a0ccf7cbdf726
-    for line in lines:
-        match = re.match("Build ID: (.*)", line.strip())
-        if match:
-            buildID = match.group(1)
-            if len(buildID) == 40:
-                return buildID
+    output = subprocess.check_output(['readelf', '-n', dso])
+    match = BUILD_ID_RE.search(output)
+    if match:
+        return match.group(1)
     return None
 
+def GetBuildID(dso):
+    """Get the build ID of the specified file if it is an ELF file. This parses the
+file directly, only falling back to readelf if the file can't be parsed. If no build
+ID is found then it returns None."""
+    try:
+        buildID = get_build_id_mmap(dso)
+    except (struct.error, KeyError, ValueError) as e:
+        log.debug('Falling back to readelf for %s: %s' % (dso, e))
+        buildID = get_build_id_readelf(dso)
+    if buildID and len(buildID) == 40:
+        return buildID
+    return None
+
+# Directories in packages that hold data, headers and docs rather than
+# binaries. Excluding these, rather than extracting only the known binary
+# directories, means tar doesn't fail on debs that lack some of them.
+NON_ELF_PATHS = ['./usr/share', './usr/include', './usr/src', './etc', './var']
+
+worker_state = threading.local()
+
+def worker_scratch_dir():
+    """Get the scratch directory for the current worker thread, which is reused for
+every deb it processes and removed at exit."""
+    if not hasattr(worker_state, 'scratch_dir'):
+        worker_state.scratch_dir = make_scratch_dir(suffix='.scanpackages')
+        atexit.register(shutil.rmtree, worker_state.scratch_dir, True)
+    return worker_state.scratch_dir
+
+def discard_worker_scratch_dir():
+    """Throw away the current worker thread's scratch directory, so that the next deb
+it processes gets a fresh one."""
+    shutil.rmtree(worker_state.scratch_dir, True)
+    del worker_state.scratch_dir
+
 def process_deb(deb_url):
     log.info('Processing deb %s...' % deb_url)
     buildid_files = []
+    tempDir = worker_scratch_dir()
+    # Anything left behind by the last deb would be credited to this one.
+    if os.listdir(tempDir):
+        discard_worker_scratch_dir()
+        tempDir = worker_scratch_dir()
     try:
-        tempDir = tempfile.mkdtemp()
-        # Then we download the package.
-        deb_file = os.path.join(tempDir, 'file.deb')
-        fetch_to_file(deb_url, deb_file)
-
-        # Now we unpack the package
-        subprocess.check_call(['dpkg-deb', '-x', deb_file, tempDir])
+        # Stream the package straight from the server into dpkg-deb and tar,
+        # skipping the parts of the tree that don't hold ELF files.
+        extract_deb(deb_url, tempDir, exclude=NON_ELF_PATHS)
 
+        # Build IDs by (device, inode), so files reached through several
+        # symlinks or hard links are only read once.
+        seen = {}
+        root_dir = os.path.realpath(tempDir)
         for root, dirs, files in os.walk(tempDir):
             for f in files:
                 path = os.path.join(root, f)
-                # There are dangling symlinks in -dbg packages...
-                if not os.path.exists(f):
+                # Absolute symlinks (common in -dev packages) point at the
+                # files on this machine, not the ones in the package.
+                real_path = os.path.realpath(path)
+                if not real_path.startswith(root_dir + os.sep):
+                    continue
+                try:
+                    st = os.lstat(real_path)
+                except OSError:
+                    # There are dangling symlinks in -dbg packages...
                     continue
-                buildID = GetBuildID(path)
+                # Opening a FIFO or device node would block or worse, and
+                # they can't be ELF files anyway.
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                key = (st.st_dev, st.st_ino)
+                if key not in seen:
+                    # Most files in a package aren't ELF files, so skip them
+                    # before doing any real work.
+                    seen[key] = GetBuildID(real_path) if is_elf(real_path) else None
+                buildID = seen[key]
                 if buildID:
                     buildid_files.append(('/' + os.path.relpath(path, tempDir),
                                           buildID))
-    finally:
-        shutil.rmtree(tempDir)
+    except Exception:
+        discard_worker_scratch_dir()
+        raise
+    try:
+        empty_dir(tempDir)
+    except OSError as e:
+        log.info('Failed to clean up after %s: %s' % (deb_url, e))
+        discard_worker_scratch_dir()
     return buildid_files
 
+def parse_html_directory_listing(url, content):
+    doc = lxml.html.fromstring(content)
+    for a in doc.iter('a'):
+        href = a.get('href')
+        text = a.text
+        if href == text:
+            yield urlparse.urljoin(url, href)
+
 def scrape_html_directory_listing(url):
-    r = requests.get(url)
+    r = SESSION.get(url)
     if r.status_code == 200:
-        doc = html5lib.parse(r.text, treebuilder='dom')
-        for a in doc.getElementsByTagName('a'):
-            href = a.getAttribute('href')
-            text = a.childNodes[0].data
-            if href == text:
-                yield urlparse.urljoin(url, href)
+        for link in parse_html_directory_listing(url, r.content):
+            yield link
+
+def fetch_html_directory_listing(url):
+    """Like scrape_html_directory_listing, but returns a list, and returns None instead
+of an empty listing if the server didn't send one."""
+    r = SESSION.get(url)
+    if r.status_code != 200:
+        log.info('Failed to fetch listing %s: %d' % (url, r.status_code))
+        return None
+    return list(parse_html_directory_listing(url, r.content))
 
 def scrape_x86_debs(url):
     archs = {'amd64', 'i386'}
@@ -116,10 +304,29 @@ def scrape_package_list(main_url):
         return json.load(open(cached_allpackages, 'rb'))
 
     log.info('Scraping package listing from %s...' % main_url)
-    package_list = []
-    for url in scrape_html_directory_listing(main_url):
-        package_list.extend(list(scrape_html_directory_listing(url)))
-        json.dump(package_list, open(cached_allpackages, 'wb'))
+    subdirs = fetch_html_directory_listing(main_url)
+    if not subdirs:
+        # Caching an empty list would make every later run scan nothing.
+        raise ValueError('No package directories found at %s' % main_url)
+    # Remember each directory's listing as it comes in, so an interrupted
+    # scrape can pick up where it left off.
+    progress = AutoSaveDict(cached_allpackages + '.partial')
+    todo = [url for url in subdirs if url not in progress]
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        listings = executor.map(fetch_html_directory_listing, todo)
+        for i, links in enumerate(listings):
+            if links is not None:
+                progress[todo[i]] = links
+    package_list = [link for url in subdirs if url in progress for link in progress[url]]
+    failed = sum(1 for url in subdirs if url not in progress)
+    if failed:
+        # Go ahead with what we have, but leave the full list uncached so
+        # that the next run retries the directories that failed.
+        log.info('Failed to list %d package directories under %s' % (failed, main_url))
+        progress.compact()
+        return package_list
+    json.dump(package_list, open(cached_allpackages, 'wb'))
+    progress.delete()
     return package_list
 
 def chunk(iterable, chunk_size):
@@ -134,29 +341,33 @@ def scrape_all_ddebs(worker_count, main_url, filter_func=None):
     ddebs = AutoSaveDict('/tmp/ddebs.json')
     processed_packages = AutoSaveDict('/tmp/processed-packages.json')
     skip_packages = {}
-    with ThreadPoolExecutor(max_workers=worker_count) as executor:
-        package_urls = [url for url in scrape_package_list(main_url) if url not in processed_packages]
-        for urls_chunk in chunk(package_urls, worker_count):
-            log.info('Processing next %d packages...' % len(urls_chunk))
-            for url, debs in zip(urls_chunk,
-                                 executor.map(scrape_x86_debs, urls_chunk)):
-                log.info('Processing package %s...' % url)
-                debs = [
-                    deb for deb in debs if deb not in ddebs
-                    # The linux-image packages are just huge.
-                    and not os.path.basename(urlparse.urlparse(deb).path).startswith('linux-image')
-                    and (filter_func(deb) if filter_func else True)
-                ]
-                log.info('%d debs to process...' % len(debs))
-                deb_jobs = dict((executor.submit(process_deb, deb), deb) for deb in debs)
-                for future in as_completed(deb_jobs):
-                    deb = deb_jobs[future]
-                    if future.exception() is not None:
-                        log.info('Error processing %s: %s' % (deb, future.exception()))
-                    else:
-                        log.info('Finished processing deb %s' % deb)
-                        ddebs[deb] = future.result()
-                processed_packages[url] = True
+    try:
+        with ThreadPoolExecutor(max_workers=worker_count) as executor:
+            package_urls = (url for url in scrape_package_list(main_url) if url not in processed_packages)
+            for urls_chunk in chunk(package_urls, worker_count):
+                log.info('Processing next %d packages...' % len(urls_chunk))
+                for url, debs in zip(urls_chunk,
+                                     executor.map(scrape_x86_debs, urls_chunk)):
+                    log.info('Processing package %s...' % url)
+                    debs = [
+                        deb for deb in debs if deb not in ddebs
+                        # The linux-image packages are just huge.
+                        and not os.path.basename(urlparse.urlparse(deb).path).startswith('linux-image')
+                        and (filter_func(deb) if filter_func else True)
+                    ]
+                    log.info('%d debs to process...' % len(debs))
+                    deb_jobs = dict((executor.submit(process_deb, deb), deb) for deb in debs)
+                    for future in as_completed(deb_jobs):
+                        deb = deb_jobs[future]
+                        if future.exception() is not None:
+                            log.info('Error processing %s: %s' % (deb, future.exception()))
+                        else:
+                            log.info('Finished processing deb %s' % deb)
+                            ddebs[deb] = future.result()
+                    processed_packages[url] = True
+    finally:
+        ddebs.compact()
+        processed_packages.compact()
 
 def is_dbg_package(url):
     name = os.path.splitext(os.path.basename(urlparse.urlparse(url).path))[0].split('_')[0]
@@ -9,24 +9,28 @@ from __future__ import print_function
 
 import concurrent.futures
 import datetime
-import itertools
-import json
+import functools
+import ijson
+import multiprocessing
+import numpy
 import optparse
 import os
+import Queue
 import requests
 import shutil
+import sqlite3
 import subprocess
 import sys
-import tempfile
+import time
 import urllib
 import urlparse
 import zipfile
 
 from collections import defaultdict
 from threading import Lock
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from common import fetch_to_file
+from common import SESSION, extract_deb, make_scratch_dir
 
 print_lock = Lock()
 p = print
@@ -37,12 +41,18 @@ def print(*a, **b):
 
 SYMBOL_SERVER_URL = 'https://s3-us-west-2.amazonaws.com/org.mozilla.crash-stats.symbols-public/v1/'
 MISSING_SYMBOLS_URL = 'https://crash-analysis.mozilla.com/crash_analysis/{date}/{date}-missing-symbols.txt'
+# Symbol files the server has, so we don't have to ask about them every run.
+KNOWN_SYMBOLS_DB = '/tmp/symbols-present.sqlite'
+KNOWN_SYMBOLS_TTL = datetime.timedelta(days=30)
+# How many dump_syms processes each dump_deb worker runs at once. The
+# worker pool is shrunk to match, so there's about one per core overall.
+DUMP_SYMS_JOBS = 2
 
 def server_has_file(filename):
     '''
     Send the symbol server a HEAD request to see if it has this symbol file.
     '''
-    r = requests.head(urlparse.urljoin(SYMBOL_SERVER_URL, urllib.quote(filename)))
+    r = SESSION.head(urlparse.urljoin(SYMBOL_SERVER_URL, urllib.quote(filename)))
     return r.status_code == 200
 
 def just_linux_symbols(file):
@@ -65,9 +75,9 @@ def munge_build_id(build_id):
     Breakpad stuffs the build id into a GUID struct so the bytes are
     flipped from the standard presentation.
     '''
-    b = map(''.join, zip(*[iter(build_id.upper())]*2))
-    return ''.join(itertools.chain(reversed(b[:4]), reversed(b[4:6]),
-                                   reversed(b[6:8]), b[8:16])) + '0'
+    b = build_id.upper()
+    return (b[6:8] + b[4:6] + b[2:4] + b[0:2] + b[10:12] + b[8:10] +
+            b[14:16] + b[12:14] + b[16:32] + '0')
 
 def fetch_missing_symbols(verbose):
     now = datetime.datetime.now()
@@ -80,7 +90,7 @@ def fetch_missing_symbols(verbose):
         if os.path.isfile(cached_path):
             content = open(cached_path, 'rb').read()
         else:
-            r = requests.get(u)
+            r = SESSION.get(u)
             if r.status_code == 200:
                 if verbose:
                     print('Fetching missing symbols from %s' % u)
@@ -94,58 +104,237 @@ def fetch_missing_symbols_from_crash(verbose, crash_id):
     url = 'https://crash-stats.mozilla.com/api/ProcessedCrash/?crash_id={crash_id}&datatype=processed'.format(crash_id = crash_id)
     if verbose:
         print('Fetching missing symbols from crash: %s' % url)
-    r = requests.get(url)
+    r = SESSION.get(url)
     if r.status_code != 200:
         return set()
     j = r.json()
     return set([(m['debug_file'], m['debug_id']) for m in j['json_dump']['modules'] if 'missing_symbols' in m])
 
+class BuildIdMap(object):
+    '''
+    A read-only map of munged build ID -> (filename, package). The IDs are
+    kept in a sorted array alongside indexes into tables of filenames and
+    packages, so that it's compact and can be memory-mapped from disk.
+    '''
+    def __init__(self, ids, files, packages):
+        self.ids = ids
+        self.files = files
+        self.packages = packages
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, build_id, default=None):
+        i = numpy.searchsorted(self.ids['id'], build_id)
+        if i < len(self.ids) and self.ids['id'][i] == build_id:
+            entry = self.ids[i]
+            return (self.files[entry['file_idx']].decode('utf-8'),
+                    self.packages[entry['pkg_idx']].decode('utf-8'))
+        return default
+
+BUILD_ID_DTYPE = [('id', 'S33'), ('file_idx', 'i4'), ('pkg_idx', 'i4')]
+
 def make_build_id_map(ddebs_file):
-    id_map = {}
-    cache_file = '/tmp/packages.json'
-    if os.path.exists(cache_file) and os.stat(cache_file).st_mtime > os.stat(ddebs_file).st_mtime:
-        return json.load(open(cache_file, 'rb'))
-    ddebs = json.load(open(ddebs_file, 'rb'))
-    for package, data in ddebs.iteritems():
-        for filename, build_id in data:
-            id_map[munge_build_id(build_id)] = (filename, package)
-    with open(cache_file, 'wb') as f:
-        json.dump(id_map, f)
-    return id_map
+    ids_file, files_file, packages_file = ('/tmp/packages-%s.npy' % name
+                                           for name in ('ids', 'files', 'packages'))
+    # The IDs are written last, so they're the freshness check.
+    if os.path.exists(ids_file) and os.stat(ids_file).st_mtime > os.stat(ddebs_file).st_mtime:
+        return BuildIdMap(numpy.load(ids_file, mmap_mode='r'),
+                          numpy.load(files_file, mmap_mode='r'),
+                          numpy.load(packages_file, mmap_mode='r'))
+    entries = {}
+    file_idx = {}
+    packages = []
+    # Stream ddebs.json rather than loading it all, since we only want
+    # one entry per file out of it.
+    with open(ddebs_file, 'rb') as f:
+        for package, data in ijson.kvitems(f, ''):
+            pkg_idx = len(packages)
+            packages.append(package.encode('utf-8'))
+            for filename, build_id in data:
+                filename = filename.encode('utf-8')
+                entries[munge_build_id(build_id)] = (file_idx.setdefault(filename, len(file_idx)),
+                                                     pkg_idx)
+    ids = numpy.array([(build_id, fi, pi) for build_id, (fi, pi) in entries.iteritems()],
+                      dtype=BUILD_ID_DTYPE)
+    ids.sort(order='id')
+    files = numpy.array(sorted(file_idx, key=file_idx.get), dtype=bytes)
+    packages = numpy.array(packages, dtype=bytes)
+    del entries, file_idx
+    if len(ids):
+        numpy.save(files_file, files)
+        numpy.save(packages_file, packages)
+        numpy.save(ids_file, ids)
+    return BuildIdMap(ids, files, packages)
 
 def make_sym_filename(filename, debug_id):
     f = os.path.basename(filename)
     return os.path.join(f, debug_id, f + '.sym')
 
-def process_deb(verbose, dump_syms, deb_url, files):
-    files = [(f, s) for (f, s) in files if not server_has_file(s)]
-    if not files:
-        # We must have all these symbols already.
-        if verbose:
+def load_known_symbols(db):
+    '''
+    Return the set of symbol files that the symbol server was seen to have
+    within the last KNOWN_SYMBOLS_TTL, forgetting any older than that.
+    '''
+    db.execute('CREATE TABLE IF NOT EXISTS present '
+               '(sym_filename TEXT PRIMARY KEY, checked REAL)')
+    db.execute('DELETE FROM present WHERE checked < ?',
+               (time.time() - KNOWN_SYMBOLS_TTL.total_seconds(),))
+    db.commit()
+    return set(row[0] for row in db.execute('SELECT sym_filename FROM present'))
+
+def prefilter_symbols(verbose, debs_to_process, worker_count=32):
+    '''
+    Check the symbol server for every symbol file of every deb at once,
+    and return a dict of only the debs (and their files) whose symbols
+    are still missing. Symbol files the server is already known to have
+    from a previous run aren't checked again.
+    '''
+    db = sqlite3.connect(KNOWN_SYMBOLS_DB)
+    present = load_known_symbols(db)
+    sym_filenames = list(set(s for files in debs_to_process.itervalues()
+                             for f, s in files) - present)
+    if verbose:
+        print('Checking the symbol server for %d symbol files' % len(sym_filenames))
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        for i, has_file in enumerate(executor.map(server_has_file, sym_filenames)):
+            if has_file:
+                present.add(sym_filenames[i])
+                db.execute('INSERT OR REPLACE INTO present VALUES (?, ?)',
+                           (sym_filenames[i], time.time()))
+            if i % 1000 == 999:
+                db.commit()
+    db.commit()
+    db.close()
+    missing = {}
+    for deb_url, files in debs_to_process.iteritems():
+        files = [(f, s) for (f, s) in files if s not in present]
+        if files:
+            missing[deb_url] = files
+        elif verbose:
+            # We must have all these symbols already.
             print('No files to process from %s' % deb_url)
-        return []
+    return missing
+
+def fetch_deb(verbose, deb_url, files):
+    '''
+    Stream a deb from the server and extract just the listed files from it
+    into a new temporary directory. Returns the directory, or None if the deb
+    couldn't be downloaded or extracted.
+    '''
     if verbose:
-        print('Processing %d files from %s' % (len(files), deb_url))
+        print('Fetching %s' % deb_url)
+    tmpdir = make_scratch_dir(suffix='.scrapedebs')
     try:
-        tmpdir = tempfile.mkdtemp(suffix='.scrapedebs')
-        deb_file = os.path.join(tmpdir, 'file.deb')
-        fetch_to_file(deb_url, deb_file)
         # Extract out just the files we want
-        subprocess.check_call('dpkg-deb --fsys-tarfile {deb} | tar x {files}'.format(deb=deb_file, files=' '.join('.' + f for f, s in files)),
-                              cwd=tmpdir,
-                              shell=True)
+        extract_deb(deb_url, tmpdir, ['.' + f for f, s in files])
+        return tmpdir
+    except (subprocess.CalledProcessError, requests.RequestException) as e:
+        print('Error fetching %s: %s' % (deb_url, e))
+        shutil.rmtree(tmpdir)
+        return None
+    except Exception:
+        shutil.rmtree(tmpdir)
+        raise
+
+def dump_deb(verbose, dump_syms, tmpdir, deb_url, files):
+    '''
+    Run dump_syms on the files extracted from a deb by fetch_deb, writing
+    each one's output to a .sym file alongside them. Returns tmpdir and a
+    list of (symbol_file, sym_path), or None (having cleaned up tmpdir) if
+    dump_syms failed.
+    '''
+    if verbose:
+        print('Processing %d files from %s' % (len(files), deb_url))
+    def finish(proc, path):
+        # Only the .sym output needs to wait around for main to zip it.
+        returncode = proc.wait()
+        os.unlink(path)
+        return returncode != 0
+    try:
         symbols = []
-        for filename, symbol_file in files:
+        running = []
+        failed = False
+        # dump_syms only handles one file per run, so run several at once.
+        for i, (filename, symbol_file) in enumerate(files):
+            if len(running) >= DUMP_SYMS_JOBS:
+                failed |= finish(*running.pop(0))
             path = os.path.join(tmpdir, filename[1:])
+            sym_path = os.path.join(tmpdir, '%d.sym' % i)
             if verbose:
                 print('Processing %s' % filename)
-            symbols.append((symbol_file,
-                            subprocess.check_output([dump_syms, path])))
-        return symbols
-    except subprocess.CalledProcessError:
-        return []
-    finally:
+            with open(sym_path, 'wb') as f:
+                running.append((subprocess.Popen([dump_syms, path], stdout=f), path))
+            symbols.append((symbol_file, sym_path))
+        for proc, path in running:
+            failed |= finish(proc, path)
+        if failed:
+            shutil.rmtree(tmpdir)
+            return None
+        return tmpdir, symbols
+    except Exception:
+        # Don't pull the directory out from under any that already started.
+        for proc, path in running:
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
         shutil.rmtree(tmpdir)
+        raise
+
+def process_debs(verbose, dump_syms, debs_to_process):
+    '''
+    Fetch debs and dump symbols from them as a pipeline, so that downloading
+    and extracting some debs (on threads) overlaps with running dump_syms on
+    others (in worker processes, sized to keep every core busy).
+    Yields the list of (symbol_file, sym_path) from each deb as it finishes.
+    The .sym files are removed once the caller moves on to the next deb.
+    '''
+    results = Queue.Queue()
+    sym_workers = max(1, multiprocessing.cpu_count() // DUMP_SYMS_JOBS)
+    net_workers = 8
+    # Each deb holds on to its scratch directory until its symbols have
+    # been zipped, so only keep enough in flight to keep both pools busy.
+    max_in_flight = sym_workers + net_workers
+    debs = debs_to_process.iteritems()
+    try:
+        # net_pool's callbacks submit to sym_pool, so sym_pool has to outlive it.
+        with ProcessPoolExecutor(max_workers=sym_workers) as sym_pool:
+            # The pool forks its workers on the first submit. Make that happen
+            # now, before net_pool has any threads that could be holding a lock
+            # (like print_lock) which the children would inherit still held.
+            sym_pool.submit(int).result()
+            with ThreadPoolExecutor(max_workers=net_workers) as net_pool:
+                def fetched(deb_url, files, future):
+                    if future.exception() is None and future.result() is not None:
+                        sym_pool.submit(dump_deb, verbose, dump_syms, future.result(),
+                                        deb_url, files).add_done_callback(results.put)
+                    else:
+                        results.put(future)
+                def submit_next():
+                    deb = next(debs, None)
+                    if deb is not None:
+                        deb_url, files = deb
+                        future = net_pool.submit(fetch_deb, verbose, deb_url, files)
+                        future.add_done_callback(functools.partial(fetched, deb_url, files))
+                for _ in range(max_in_flight):
+                    submit_next()
+                for _ in range(len(debs_to_process)):
+                    result = results.get().result()
+                    if result is not None:
+                        tmpdir, symbols = result
+                        try:
+                            yield symbols
+                        finally:
+                            shutil.rmtree(tmpdir)
+                    # That deb is finished with its scratch space, so start another.
+                    submit_next()
+    finally:
+        # If we stopped early, both pools have finished by now, so clean up
+        # after every deb that was still in the pipeline.
+        while not results.empty():
+            future = results.get()
+            if future.exception() is None and future.result() is not None:
+                shutil.rmtree(future.result()[0])
 
 def main():
     parser = optparse.OptionParser()
@@ -179,14 +368,20 @@ def main():
             debs_to_process[ddeb].append((filename, sym_filename))
     if options.verbose:
         print('%d ddebs to process (%d files)' % (len(debs_to_process), sum(len(f) for f in debs_to_process.itervalues())))
+    # Skip anything the symbol server already has.
+    debs_to_process = prefilter_symbols(options.verbose, debs_to_process)
+    if options.verbose:
+        print('%d ddebs with missing symbols (%d files)' % (len(debs_to_process), sum(len(f) for f in debs_to_process.itervalues())))
     # Now fetch each deb and dump symbols from the files within.
     file_list = []
-    with zipfile.ZipFile('symbols.zip', 'w', zipfile.ZIP_DEFLATED) as zf, ThreadPoolExecutor(max_workers=4) as executor:
-        for result in executor.map(lambda x : process_deb(options.verbose, options.dump_syms, *x), debs_to_process.iteritems()):
-            for symbol_file, contents in result:
-                if symbol_file and contents:
+    with zipfile.ZipFile('symbols.zip', 'w', zipfile.ZIP_DEFLATED) as zf:
+        for result in process_debs(options.verbose, options.dump_syms, debs_to_process):
+            for symbol_file, sym_path in result:
+                # Let zipfile read the .sym from disk rather than holding
+                # the whole thing in memory.
+                if symbol_file and os.path.getsize(sym_path):
                     file_list.append(symbol_file)
-                    zf.writestr(symbol_file, contents)
+                    zf.write(sym_path, symbol_file)
         # Add an index file.
         zf.writestr('ubuntusyms-1.0-Linux-{date}-symbols.txt'.format(date=datetime.datetime.now().strftime('%Y%m%d%H%M%S')),
                     '\n'.join(file_list) + '\n')
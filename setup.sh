@@ -1,3 +1,3 @@
 sudo apt-get update
 sudo apt-get install python-pip
-sudo pip install html5lib futures requests boto
+sudo pip install lxml futures requests boto ijson numpy
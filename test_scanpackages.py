@@ -0,0 +1,87 @@
+import distutils.spawn
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import scanpackages
+
+def readelf_build_id(path):
+    output = subprocess.check_output(['readelf', '-n', path])
+    return re.search(r'Build ID: (\w+)', output.decode('ascii')).group(1)
+
+def as_str(build_id):
+    return build_id.decode('ascii') if isinstance(build_id, bytes) else build_id
+
+@unittest.skipUnless(all(distutils.spawn.find_executable(tool)
+                         for tool in ('gcc', 'ld', 'objcopy', 'readelf')),
+                     'needs gcc, ld, objcopy and readelf')
+class ELFTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        source = os.path.join(self.tmpdir, 'lib.c')
+        with open(source, 'w') as f:
+            f.write('int answer(void) { return 42; }\n')
+        self.obj = os.path.join(self.tmpdir, 'lib.o')
+        subprocess.check_call(['gcc', '-c', '-fPIC', '-g', source, '-o', self.obj])
+        self.so = os.path.join(self.tmpdir, 'lib.so')
+        subprocess.check_call(['gcc', '-shared', '-Wl,--build-id', self.obj, '-o', self.so])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+class GetBuildIDMmapTests(ELFTestCase):
+    def check(self, path):
+        build_id = scanpackages.get_build_id_mmap(path)
+        self.assertTrue(build_id)
+        self.assertEqual(as_str(build_id), readelf_build_id(path))
+
+    def test_shared_object(self):
+        self.check(self.so)
+
+    def test_debug_file(self):
+        debug = os.path.join(self.tmpdir, 'lib.so.debug')
+        subprocess.check_call(['objcopy', '--only-keep-debug', self.so, debug])
+        self.check(debug)
+
+    def test_relocatable_object(self):
+        relocatable = os.path.join(self.tmpdir, 'lib-r.o')
+        subprocess.check_call(['ld', '-r', '--build-id', self.obj, '-o', relocatable])
+        self.check(relocatable)
+
+    def test_not_elf(self):
+        path = os.path.join(self.tmpdir, 'README')
+        with open(path, 'w') as f:
+            f.write('Not an ELF file at all.\n')
+        self.assertEqual(scanpackages.get_build_id_mmap(path), None)
+
+class ProcessDebTests(ELFTestCase):
+    def setUp(self):
+        super(ProcessDebTests, self).setUp()
+        self.extract_deb = scanpackages.extract_deb
+        scanpackages.extract_deb = self.fake_extract_deb
+
+    def tearDown(self):
+        scanpackages.extract_deb = self.extract_deb
+        super(ProcessDebTests, self).tearDown()
+
+    def fake_extract_deb(self, url, dest, members=(), exclude=()):
+        libdir = os.path.join(dest, 'usr', 'lib')
+        os.makedirs(libdir)
+        shutil.copy(self.so, os.path.join(libdir, 'libreal.so'))
+        os.symlink('libreal.so', os.path.join(libdir, 'libreal.so.1'))
+        # Like the absolute symlinks in -dev packages, this points outside
+        # the package, at a file on the scanning machine.
+        os.symlink(self.so, os.path.join(libdir, 'libabs.so'))
+
+    def test_symlinks(self):
+        build_id = readelf_build_id(self.so)
+        self.assertEqual(sorted((path, as_str(b))
+                                for path, b in scanpackages.process_deb('http://example.com/x.deb')),
+                         [('/usr/lib/libreal.so', build_id),
+                          ('/usr/lib/libreal.so.1', build_id)])
+
+if __name__ == '__main__':
+    unittest.main()